@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
+import io
 import os
 import re
 import shlex
@@ -9,9 +10,12 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
+from itertools import chain
 from pathlib import Path
-from typing import Optional, Tuple, Dict, List
+from typing import IO, Callable, Optional, TextIO, Tuple, Dict, List
 
 # === Конфигурация соединения с YDB ===
 YDB_SECURE_ENDPOINT: str = "grpcs://ydb.serverless.yandexcloud.net:2135"
@@ -46,21 +50,35 @@ def build_dsn(endpoint: str, db_path: str, access_token: str) -> str:
     )
 
 
+_TOKEN_RE = re.compile(r"(token=)[^&'\"]+")
+
+
 def mask_secrets_in_text(s: str) -> str:
-    return re.sub(r"(token=)[^&'\"]+", r"\1***", s)
+    if "token=" not in s:
+        return s  # нечего маскировать — regex не запускаем
+    return _TOKEN_RE.sub(r"\1***", s)
+
 
+_GOOSE_PATH: Optional[str] = None  # абсолютный путь к goose, найденный check_goose_installed
 
-def check_goose_installed() -> None:
+
+def check_goose_installed(strict: bool = False) -> None:
+    global _GOOSE_PATH
     path = shutil.which("goose")
     if not path:
         raise RuntimeError(
             "> Не найден 'goose' в PATH. Установи: "
             "go install github.com/pressly/goose/v3/cmd/goose@latest"
         )
-    try:
-        subprocess.run([path, "-h"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    except Exception:
+    if not os.access(path, os.X_OK):
         raise RuntimeError("> 'goose' найден, но не запускается. Проверь установку/PATH.")
+    if strict:
+        # Пробный запуск goose -h — лишний процесс, поэтому только по --strict-check
+        try:
+            subprocess.run([path, "-h"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        except Exception:
+            raise RuntimeError("> 'goose' найден, но не запускается. Проверь установку/PATH.")
+    _GOOSE_PATH = path
 
 
 @dataclass
@@ -70,18 +88,37 @@ class ProcResult:
     err: str
 
 
+def _pump_stream(stream: IO[str], sink: List[str], echo: Optional[TextIO]) -> None:
+    for line in stream:
+        sink.append(line)
+        if echo is not None:
+            echo.write(line)
+            echo.flush()
+    stream.close()
+
+
 def run_goose(args: List[str]) -> ProcResult:
     printable = " ".join(shlex.quote(a) for a in args)
     if MASK_SECRETS_IN_LOGS:
         printable = mask_secrets_in_text(printable)
-    print(f"\n$ {printable}")
-    cp = subprocess.run(args, text=True, capture_output=True)
-    out, err = cp.stdout or "", cp.stderr or ""
-    if out.strip():
-        print(out.rstrip())
-    if cp.returncode != 0 and err.strip():
+    print(f"\n$ {printable}", flush=True)
+    if args and args[0] == "goose" and _GOOSE_PATH:
+        args = [_GOOSE_PATH, *args[1:]]  # без повторного поиска по PATH
+    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=-1)
+    out_lines: List[str] = []
+    err_lines: List[str] = []
+    # stdout показываем по мере поступления; stderr копим и печатаем только при ошибке,
+    # чтобы «шум» закрытия соединения не засорял успешный вывод.
+    # stdout читаем в текущем потоке — печать идёт туда же, куда и остальной вывод задачи
+    err_reader = threading.Thread(target=_pump_stream, args=(p.stderr, err_lines, None), daemon=True)
+    err_reader.start()
+    _pump_stream(p.stdout, out_lines, sys.stdout)
+    err_reader.join()
+    code = p.wait()
+    out, err = "".join(out_lines), "".join(err_lines)
+    if code != 0 and err.strip():
         print(err.rstrip())
-    return ProcResult(cp.returncode, out, err)
+    return ProcResult(code, out, err)
 
 
 # ---------- helpers: goose ошибки ----------
@@ -105,11 +142,16 @@ PATTERNS: List[Tuple[str, str, bool]] = [
     (r"failed to close DB.*DeadlineExceeded", "> Команда выполнена, но закрытие соединения истекло — игнорируем.", True),
 ]
 
+# Компилируем один раз при импорте, а не на каждый вызов goose
+COMPILED_PATTERNS: Tuple[Tuple[re.Pattern, str, bool], ...] = tuple(
+    (re.compile(p, re.IGNORECASE | re.DOTALL), msg, cont) for p, msg, cont in PATTERNS
+)
+
 
 def explain_error(stderr: str, stdout: str) -> Tuple[str, bool]:
     s = f"{stdout}\n{stderr}"
-    for pat, msg, cont in PATTERNS:
-        if re.search(pat, s, flags=re.IGNORECASE | re.DOTALL):
+    for rx, msg, cont in COMPILED_PATTERNS:
+        if rx.search(s):
             return msg, cont
     return ("> Неизвестная ошибка goose/YDB — смотри stderr выше.", False)
 
@@ -138,11 +180,18 @@ def pick_migration_file(start_dir: Path) -> Path:
 
 # ---------- парсинг SQL: только абсолютные пути ----------
 
-ABS_PATH_IN_BACKTICKS = re.compile(r"`(/ru-central1/[^`]+)`")
+# group(1) — абсолютный путь до таблицы; database path из него берёт extract_db_path_from_abs_table
+ABS_PATH_IN_BACKTICKS = re.compile(r"`(/ru-central1/[^`\r\n]+)`")
+# Разрывы строк, которые splitlines() учитывает помимо \n и \r\n
+_OTHER_LINE_BREAKS_RE = re.compile(r"\r(?!\n)|[\v\f\x1c-\x1e\x85\u2028\u2029]")
+_RE_VER_LONG = re.compile(r"(\d{6,})")
+_RE_VER_ANY = re.compile(r"(\d+)")
+_RE_VERSION_LINE = re.compile(r"version\s+(\d+)", re.IGNORECASE)
+_DBPATH_RE = re.compile(r"^/ru-central1/[^/]+/[^/]+")
 
 def extract_version_from_filename(file_name: str) -> Optional[int]:
     # НЕ валидируем строго. Берём первую «длинную» последовательность цифр.
-    m = re.search(r"(\d{6,})", file_name) or re.search(r"(\d+)", file_name)
+    m = _RE_VER_LONG.search(file_name) or _RE_VER_ANY.search(file_name)
     if not m:
         return None
     try:
@@ -151,17 +200,28 @@ def extract_version_from_filename(file_name: str) -> Optional[int]:
         return None
 
 
+_UP_DOWN_RE = re.compile(r"--\s*\+goose\s+Up(.*?)--\s*\+goose\s+Down", re.IGNORECASE | re.DOTALL)
+_UP_ONLY_RE = re.compile(r"--\s*\+goose\s+Up(.*)", re.IGNORECASE | re.DOTALL)
+# Метки регистронезависимы, как и регулярки выше (-- +GOOSE Up тоже валиден)
+_GOOSE_MARK_RE = re.compile(r"\+goose", re.IGNORECASE)
+
+
 def split_goose_sections(sql_text: str) -> Tuple[str, str]:
     """
     Возвращает (up_text, down_text). Если метки не найдены — up_text = весь файл, down_text = "".
     """
-    m = re.search(r"(?s)--\s*\+goose\s+Up(.*?)--\s*\+goose\s+Down", sql_text, flags=re.IGNORECASE)
+    first = _GOOSE_MARK_RE.search(sql_text)
+    if first is None:
+        return sql_text, ""  # меток goose нет вовсе — тяжёлые регулярки не запускаем
+    # Раньше первой метки искать нечего: сканируем с начала её строки
+    pos = sql_text.rfind("\n", 0, first.start()) + 1
+    m = _UP_DOWN_RE.search(sql_text, pos)
     if m:
         up_text = m.group(1)
         down_text = sql_text[m.end():]
         return up_text, down_text
     # Нет Down — попробуем только Up
-    m2 = re.search(r"(?s)--\s*\+goose\s+Up(.*)", sql_text, flags=re.IGNORECASE)
+    m2 = _UP_ONLY_RE.search(sql_text, pos)
     if m2:
         return m2.group(1), ""
     # Нет меток — берём всё как Up
@@ -172,12 +232,8 @@ def extract_db_path_from_abs_table(abs_table_path: str) -> Optional[str]:
     """
     Преобразование /ru-central1/<cloud>/<db>/<...> -> /ru-central1/<cloud>/<db>
     """
-    if not abs_table_path.startswith("/ru-central1/"):
-        return None
-    parts = abs_table_path.strip("/").split("/")
-    if len(parts) < 3:
-        return None
-    return "/" + "/".join(parts[:3])
+    m = _DBPATH_RE.match(abs_table_path)
+    return m.group(0) if m else None
 
 
 def group_sql_lines_by_dbpath(sql_text: str) -> Dict[str, List[str]]:
@@ -186,39 +242,61 @@ def group_sql_lines_by_dbpath(sql_text: str) -> Dict[str, List[str]]:
     Группируем по database path.
     """
     groups: Dict[str, List[str]] = {}
-    for line in sql_text.splitlines():
-        m = ABS_PATH_IN_BACKTICKS.search(line)
-        if not m:
-            continue  # по требованию — игнорируем строки без абсолютного пути
-        abs_path = m.group(1)
-        db_path = extract_db_path_from_abs_table(abs_path)
+    if "/ru-central1/" not in sql_text:
+        return groups  # быстрый выход без regex (например, пустая секция Down)
+    if _OTHER_LINE_BREAKS_RE.search(sql_text):
+        # Редкий случай (одиночный \r, \f, \u2028…): режем через splitlines(), как раньше,
+        # чтобы строки из разных баз не склеились в одну
+        for line in sql_text.splitlines():
+            m = ABS_PATH_IN_BACKTICKS.search(line)
+            if not m:
+                continue
+            db_path = extract_db_path_from_abs_table(m.group(1))
+            if not db_path:
+                continue
+            groups.setdefault(sys.intern(db_path), []).append(line.rstrip())
+        return groups
+    line_end = -1
+    # Один проход regex по всему тексту: строки без абсолютного пути вообще не трогаем
+    for m in ABS_PATH_IN_BACKTICKS.finditer(sql_text):
+        if m.start() < line_end:
+            continue  # строка уже решена по первому пути в ней
+        line_start = sql_text.rfind("\n", 0, m.start()) + 1
+        line_end = sql_text.find("\n", m.end())
+        if line_end == -1:
+            line_end = len(sql_text)
+        # Как и раньше, строку определяет только первый путь в ней: если он не даёт
+        # database path, строка пропускается, даже если дальше есть корректный путь
+        db_path = extract_db_path_from_abs_table(m.group(1))
         if not db_path:
             continue
-        groups.setdefault(db_path, []).append(line.rstrip())
+        db_path = sys.intern(db_path)  # один объект строки на базу для всех строк группы
+        groups.setdefault(db_path, []).append(sql_text[line_start:line_end].rstrip())
     return groups
 
 
-def build_subset_migration(up_lines: List[str], down_lines: List[str]) -> str:
+_UP_HDR = b"-- +goose Up\n-- +goose StatementBegin\n"
+_DOWN_HDR = b"\n-- +goose Down\n-- +goose StatementBegin\n"
+_STMT_END = b"-- +goose StatementEnd\n"
+
+
+def build_subset_migration(up_lines: List[str], down_lines: List[str]) -> bytes:
     """
-    Строим минимальную миграцию для выбранного database path.
+    Строим минимальную миграцию для выбранного database path (сразу в UTF-8).
     Секции Up/Down оборачиваем в один StatementBegin/End на секцию.
     """
-    up_block = "\n".join(up_lines).strip()
-    down_block = "\n".join(down_lines).strip()
+    up_block = "\n".join(up_lines).strip().encode("utf-8")
+    down_block = "\n".join(down_lines).strip().encode("utf-8")
 
     # Обязательно оставляем обе секции, даже если одна пустая — goose не против.
-    parts = ["-- +goose Up", "-- +goose StatementBegin"]
+    parts = [_UP_HDR]
     if up_block:
-        parts.append(up_block)
-    parts.append("-- +goose StatementEnd")
-    parts.append("")
-    parts.append("-- +goose Down")
-    parts.append("-- +goose StatementBegin")
+        parts += [up_block, b"\n"]
+    parts += [_STMT_END, _DOWN_HDR]
     if down_block:
-        parts.append(down_block)
-    parts.append("-- +goose StatementEnd")
-    parts.append("")
-    return "\n".join(parts)
+        parts += [down_block, b"\n"]
+    parts.append(_STMT_END)
+    return b"".join(parts)
 
 
 # ---------- goose действия ----------
@@ -237,9 +315,13 @@ def goose_status(dsn: str, migrations_dir: Path) -> None:
 def goose_version(dsn: str, migrations_dir: Path) -> Optional[int]:
     args = ["goose", "-dir", str(migrations_dir), "ydb", dsn, "version"]
     pr = run_goose(args)
-    txt = (pr.out or "") + "\n" + (pr.err or "")
-    m = re.search(r"version\s+(\d+)", txt, re.IGNORECASE)
-    if (pr.code == 0 or "failed to close DB" in txt) and m:
+    m = None
+    for txt in (pr.out, pr.err):  # без склейки out+err: ищем по потокам, до первого совпадения
+        m = _RE_VERSION_LINE.search(txt or "")
+        if m:
+            break
+    closed_noise = "failed to close DB" in (pr.out or "") or "failed to close DB" in (pr.err or "")
+    if (pr.code == 0 or closed_noise) and m:
         try:
             return int(m.group(1))
         except ValueError:
@@ -258,11 +340,144 @@ def goose_up_to(dsn: str, migrations_dir: Path, version: int) -> None:
         raise SystemExit(1)
 
 
+# ---------- применение по database path ----------
+
+MAX_PARALLEL_DBS = 8  # сколько баз обрабатываем одновременно
+
+
+class _ThreadOutput(io.TextIOBase):
+    """
+    Подмена sys.stdout на время параллельной обработки: потоки, вызвавшие begin(),
+    пишут в свой буфер, остальные — как обычно в исходный stdout.
+    """
+
+    def __init__(self, target: TextIO):
+        self._target = target
+        self._local = threading.local()
+
+    def begin(self) -> None:
+        self._local.buf = io.StringIO()
+
+    def end(self) -> str:
+        buf = self._local.buf
+        self._local.buf = None
+        return buf.getvalue()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        buf = getattr(self._local, "buf", None)
+        if buf is None:
+            return self._target.write(s)
+        return buf.write(s)
+
+    def flush(self) -> None:
+        if getattr(self._local, "buf", None) is None:
+            self._target.flush()
+
+
+def apply_subset_for_db(
+    db_path: str,
+    up_lines: List[str],
+    down_lines: List[str],
+    file_name: str,
+    version: int,
+    token: str,
+    verbose: bool,
+    work_dir: Path,
+) -> None:
+    print(f"\n=== ▶ Применение под-миграции для базы: {db_path} ===")
+    subset_sql = build_subset_migration(up_lines=up_lines, down_lines=down_lines)
+
+    # отдельная папка под базу и файл с ТЕМ ЖЕ именем (чтобы версия совпала)
+    work_dir.mkdir()
+    tmp_file = work_dir / file_name
+    tmp_file.write_bytes(subset_sql)
+
+    dsn = build_dsn(YDB_SECURE_ENDPOINT, db_path, token)
+
+    # Каждый вызов goose — новый процесс и новое соединение с YDB, поэтому
+    # статус до применения показываем только в --verbose: version и так
+    # проверяет соединение и даёт текущую версию
+    if verbose:
+        print("🔎 Статус до применения:")
+        goose_status(dsn, work_dir)
+
+    cur_ver = goose_version(dsn, work_dir)
+    if cur_ver is not None:
+        print(f"> Текущая версия БД: {cur_ver}")
+
+    applied = cur_ver is None or cur_ver < version
+    if applied:
+        print(f"🚀 Применяем: up-to {version} (dir = {work_dir})")
+        goose_up_to(dsn, work_dir, version)
+    else:
+        print(f"> База уже на версии {cur_ver} ≥ {version} — up-to ничего не сделает.")
+
+    if applied or verbose:
+        print("🔎 Статус после применения:")
+        goose_status(dsn, work_dir)
+
+    print(f"=== ✔ Завершено для: {db_path} ===")
+
+
+def run_per_db_parallel(worker: Callable[[str], None], db_paths: List[str]) -> None:
+    """
+    Базы независимы, поэтому goose для них запускаем параллельно.
+    Вывод каждой задачи копится отдельно и печатается целиком, строго в порядке баз
+    в файле (как при последовательном прогоне). После первой ошибки ещё не начатые
+    базы отменяются, уже запущенные доводятся до конца; пробрасывается ошибка
+    первой по порядку упавшей базы.
+    """
+    out = _ThreadOutput(sys.stdout)
+
+    def task(db_path: str) -> Tuple[str, Optional[BaseException]]:
+        out.begin()
+        err: Optional[BaseException] = None
+        try:
+            worker(db_path)
+        except BaseException as e:  # включая SystemExit из goose_*
+            err = e
+        return out.end(), err
+
+    first_err: Optional[BaseException] = None
+    prev_stdout = sys.stdout
+    sys.stdout = out
+    try:
+        with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_DBS, len(db_paths))) as ex:
+            futures = [ex.submit(task, dbp) for dbp in db_paths]
+            next_print = 0
+            for fut in as_completed(futures):
+                if not fut.cancelled() and fut.result()[1] is not None:
+                    for f in futures:
+                        f.cancel()  # отменяются только ещё не начатые
+                # Печатаем готовый «префикс» списка — так порядок логов не зависит от таймингов
+                while next_print < len(futures) and futures[next_print].done():
+                    f = futures[next_print]
+                    if f.cancelled():
+                        prev_stdout.write(f"\n=== ⏹ Пропущено из-за ошибки в другой базе: {db_paths[next_print]} ===\n")
+                    else:
+                        log, err = f.result()
+                        prev_stdout.write(log)
+                        if err is not None and first_err is None:
+                            first_err = err
+                    prev_stdout.flush()
+                    next_print += 1
+    finally:
+        sys.stdout = prev_stdout
+    if first_err is not None:
+        raise first_err
+
+
 # ---------- main ----------
 
 def main() -> None:
+    verbose = "--verbose" in sys.argv[1:]  # статус goose и до, и после применения
+    strict_check = "--strict-check" in sys.argv[1:]  # пробный запуск goose -h при проверке
+
     print("🔍 Проверяем goose...")
-    check_goose_installed()
+    check_goose_installed(strict=strict_check)
 
     print("🔐 Читаем IAM-токен...")
     token = read_iam_token(IAM_TOKEN_FILE)
@@ -282,7 +497,7 @@ def main() -> None:
         sys.exit(2)
 
     # читаем SQL
-    raw_sql = chosen_file.read_text(encoding="utf-8", errors="ignore")
+    raw_sql = chosen_file.read_bytes().decode("utf-8", "ignore")
 
     # делим на Up/Down
     up_text, down_text = split_goose_sections(raw_sql)
@@ -298,8 +513,9 @@ def main() -> None:
         )
         sys.exit(0)
 
-    # Список всех database path, которые встречаются (объединяем из Up и Down)
-    all_db_paths = list({*up_groups.keys(), *down_groups.keys()})
+    # Список всех database path, которые встречаются (объединяем из Up и Down).
+    # dict.fromkeys сохраняет порядок появления в файле — запуски воспроизводимы
+    all_db_paths = list(dict.fromkeys(chain(up_groups, down_groups)))
 
     print(f"📦 Обнаружены database path в файле миграции: {len(all_db_paths)}")
     for dbp in all_db_paths:
@@ -307,39 +523,27 @@ def main() -> None:
         n_down = len(down_groups.get(dbp, []))
         print(f"   • {dbp} — Up: {n_up} stmt, Down: {n_down} stmt")
 
-    # Для каждого database path — делаем временную "под-миграцию" и применяем только её
-    for db_path in all_db_paths:
-        print(f"\n=== ▶ Применение под-миграции для базы: {db_path} ===")
-        subset_sql = build_subset_migration(
-            up_lines=up_groups.get(db_path, []),
-            down_lines=down_groups.get(db_path, []),
-        )
-
-        # создаём временную директорию и файл с ТЕМ ЖЕ именем (чтобы версия совпала)
-        with tempfile.TemporaryDirectory(prefix=f"goose_{version}_") as tmpdir:
-            tmpdir_path = Path(tmpdir)
-            tmp_file = tmpdir_path / chosen_file.name
-            tmp_file.write_text(subset_sql, encoding="utf-8")
-
-            dsn = build_dsn(YDB_SECURE_ENDPOINT, db_path, token)
-
-            print("🔎 Статус до применения:")
-            goose_status(dsn, tmpdir_path)
-
-            cur_ver = goose_version(dsn, tmpdir_path)
-            if cur_ver is not None:
-                print(f"> Текущая версия БД: {cur_ver}")
-
-            if cur_ver is None or cur_ver < version:
-                print(f"🚀 Применяем: up-to {version} (dir = {tmpdir_path})")
-                goose_up_to(dsn, tmpdir_path, version)
-            else:
-                print(f"> База уже на версии {cur_ver} ≥ {version} — up-to ничего не сделает.")
-
-            print("🔎 Статус после применения:")
-            goose_status(dsn, tmpdir_path)
-
-        print(f"=== ✔ Завершено для: {db_path} ===")
+    # Для каждого database path — делаем временную "под-миграцию" и применяем только её.
+    # Общая временная папка на весь запуск, внутри — своя подпапка на каждую базу.
+    db_index = {dbp: i for i, dbp in enumerate(all_db_paths)}
+    with tempfile.TemporaryDirectory(prefix=f"goose_{version}_") as tmp_root:
+
+        def _apply_one(db_path: str) -> None:
+            apply_subset_for_db(
+                db_path,
+                up_lines=up_groups.get(db_path, []),
+                down_lines=down_groups.get(db_path, []),
+                file_name=chosen_file.name,
+                version=version,
+                token=token,
+                verbose=verbose,
+                work_dir=Path(tmp_root) / str(db_index[db_path]),
+            )
+
+        if len(all_db_paths) == 1:
+            _apply_one(all_db_paths[0])  # одна база — без буферизации, вывод goose идёт сразу
+        else:
+            run_per_db_parallel(_apply_one, all_db_paths)
 
     print("\n✅ Все под-миграции по обнаруженным database path успешно обработаны.")
 
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
+import functools
 import os
 import sys
 
@@ -27,6 +28,7 @@ def _enable_vt_win() -> bool:
     except Exception:
         return False
 
+@functools.lru_cache(maxsize=1)  # ctypes/colorama-инициализация нужна один раз за процесс
 def _init_ansi() -> bool:
     if os.name == "nt":
         if colorama is not None:
@@ -72,11 +74,15 @@ BG = {
     "bg белый": "\x1b[47m",
 }
 
+# Набор цветов фиксирован — строки примеров собираем один раз при импорте
+_FG_LINES = tuple(f"{code}{name}{RESET}" for name, code in FG.items())
+_BG_LINES = tuple(f"{code}\x1b[30m{name}{RESET}" for name, code in BG.items())
+_GRADIENT = "".join(f"\x1b[38;2;{r};{255 - r};128m█" for r in range(0, 256, 32)) + RESET
+
 def main() -> None:
     _init_ansi()
     print("Пример цветов (текст):")
-    for name, code in FG.items():
-        print(f"{code}{name}{RESET}")
+    sys.stdout.write("\n".join(_FG_LINES) + "\n")
     print()
     print("Пример атрибутов:")
     print(f"{BOLD}полужирный{RESET}")
@@ -84,16 +90,10 @@ def main() -> None:
     print(f"{ITALIC}курсив{RESET}")
     print()
     print("Пример фона:")
-    for name, code in BG.items():
-        print(f"{code}\x1b[30m{name}{RESET}")
+    sys.stdout.write("\n".join(_BG_LINES) + "\n")
     print()
     print("Truecolor градиент:")
-    blocks = []
-    for r in range(0, 256, 32):
-        g = 255 - r
-        b = 128
-        blocks.append(f"\x1b[38;2;{r};{g};{b}m█")
-    print("".join(blocks) + RESET)
+    print(_GRADIENT)
 
 if __name__ == "__main__":
     main()
@@ -2,36 +2,60 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
-import colorsys
+import functools
 import hashlib
 import json
 import os
+import queue
 import re
 import shlex
 import subprocess
 import sys
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Sequence, Tuple
-from urllib.parse import urlparse, parse_qs
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Set, Tuple
+from urllib.parse import unquote_plus
 
 try:
     import colorama
 except Exception:
     colorama = None
 
+try:
+    import orjson  # необязательно: быстрый разбор JSON (вывод yc, кэш describe)
+    _jloads = orjson.loads
+except Exception:
+    _jloads = json.loads
+
+try:
+    import ydb as ydb_sdk  # необязательно: один gRPC-драйвер вместо запуска ydb CLI на каждый вызов
+except Exception:
+    ydb_sdk = None
+
 import tkinter as tk
 from tkinter import ttk, messagebox
 
 ROOT = Path(__file__).resolve().parent
 MIGRATIONS_DIR = ROOT
 IAM_TOKEN_FILE = ROOT / "iam.token"
+DESCRIBE_CACHE_DIR = ROOT / ".describe_cache"
 
 YC_TIMEOUT = 20
 YDB_TIMEOUT = 40
+DESCRIBE_WORKERS = 16  # сколько `ydb scheme describe` держим в полёте одновременно
+DESCRIBE_CACHE_TTL = 600  # сек.; кэш describe на диске между запусками
 
 DEBUG_RAW = os.environ.get("YDB_MIGRATIONS_DEBUG", "1").lower() not in {"0", "false", "no"}
+DESCRIBE_NO_CACHE = os.environ.get("YDB_DESC_NO_CACHE", "0").lower() not in {"0", "false", "no"}
+USE_YDB_SDK = ydb_sdk is not None and os.environ.get("YDB_USE_SDK", "1").lower() not in {"0", "false", "no"}
+SDK_CONNECT_TIMEOUT = 10
+@functools.lru_cache(maxsize=1)
 def _enable_vt_win() -> bool:
     try:
         import ctypes
@@ -78,29 +102,39 @@ class RunResult:
 class CmdError(RuntimeError):
     pass
 
+@functools.lru_cache(maxsize=32)  # PATH за время работы скрипта не меняется
 def which(bin_name: str) -> Optional[str]:
     from shutil import which as _which
     return _which(bin_name)
 
+# Общий замок на печать: run()/describe могут вызываться из пула потоков
+_PRINT_LOCK = threading.RLock()
+
 def _log_block(label: str, text: str) -> None:
     if not DEBUG_RAW:
         return
     prefix = "\x1b[90m\x1b[3m" if ANSI_OK else ""
     suffix = "\x1b[0m" if ANSI_OK else ""
     indent = "" if ANSI_OK else "  "
-    print()
-    print(f"{indent}{prefix}=== {label}_BEGIN ==={suffix}")
+    # Собираем блок целиком и пишем одним write: на больших листингах это тысячи print'ов
+    buf = ["", f"{indent}{prefix}=== {label}_BEGIN ==={suffix}"]
     if text:
-        t = text.rstrip("\n")
-        for ln in t.splitlines():
-            print(f"{indent}{prefix}{ln}{suffix}")
-    print(f"{indent}{prefix}=== {label}_END ==={suffix}")
-    print()
+        buf.extend(f"{indent}{prefix}{ln}{suffix}" for ln in text.rstrip("\n").splitlines())
+    buf.append(f"{indent}{prefix}=== {label}_END ==={suffix}")
+    buf.append("")
+    block = "\n".join(buf) + "\n"
+    with _PRINT_LOCK:
+        sys.stdout.write(block)
 
 def run(cmd: Sequence[str], timeout: int, *, echo_stdout: bool = False, echo_stderr: bool = True, raw_label: Optional[str] = None) -> RunResult:
     printable = " ".join(shlex.quote(x) for x in cmd)
-    print()
-    print(f"$ {printable}")
+    # В главном потоке печатаем команду сразу (видно, чего ждём); из пула — вместе
+    # с её выводом одним блоком, чтобы параллельные вызовы не перемешивались
+    echo_now = threading.current_thread() is threading.main_thread()
+    if echo_now:
+        with _PRINT_LOCK:
+            print()
+            print(f"$ {printable}")
     try:
         cp = subprocess.run(
             cmd,
@@ -113,17 +147,74 @@ def run(cmd: Sequence[str], timeout: int, *, echo_stdout: bool = False, echo_std
     except subprocess.TimeoutExpired as e:
         raise CmdError(f"> Таймаут: {printable}") from e
     out, err = cp.stdout or "", cp.stderr or ""
-    if raw_label is not None:
-        _log_block(raw_label + "_STDOUT", out)
-        if err.strip():
-            _log_block(raw_label + "_STDERR", err)
-    # Если вывод уже показан в RAW-блоке, не дублируем его обычной печатью
-    if raw_label is None and echo_stdout and out.strip():
-        print(out.rstrip())
-    if raw_label is None and cp.returncode != 0 and echo_stderr and err.strip():
-        print(err.rstrip())
+    with _PRINT_LOCK:
+        if not echo_now:
+            print()
+            print(f"$ {printable}")
+        if raw_label is not None:
+            _log_block(raw_label + "_STDOUT", out)
+            if err.strip():
+                _log_block(raw_label + "_STDERR", err)
+        # Если вывод уже показан в RAW-блоке, не дублируем его обычной печатью
+        if raw_label is None and echo_stdout and out.strip():
+            print(out.rstrip())
+        if raw_label is None and cp.returncode != 0 and echo_stderr and err.strip():
+            print(err.rstrip())
     return RunResult(cp.returncode, out, err)
 
+def run_stream(cmd: Sequence[str], timeout: int, line_cb: Callable[[str], None], *, raw_label: Optional[str] = None) -> RunResult:
+    """
+    Как run(), но stdout не копится целиком: каждая строка сразу уходит в line_cb.
+    В RunResult.out ничего не кладём; сырой вывод для RAW-блока держим, только если включён DEBUG_RAW.
+    """
+    printable = " ".join(shlex.quote(x) for x in cmd)
+    with _PRINT_LOCK:
+        print()
+        print(f"$ {printable}")
+    raw_lines: Optional[List[str]] = [] if (raw_label is not None and DEBUG_RAW) else None
+    err_chunks: List[str] = []
+    p = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        encoding="utf-8",
+        errors="replace",
+    )
+    # stderr читаем отдельно, иначе заполненный pipe stderr может подвесить процесс
+    err_reader = threading.Thread(target=lambda: err_chunks.append(p.stderr.read()), daemon=True)
+    err_reader.start()
+    timed_out = threading.Event()
+
+    def _on_timeout() -> None:
+        timed_out.set()
+        p.kill()
+
+    killer = threading.Timer(timeout, _on_timeout)
+    killer.start()
+    try:
+        for ln in p.stdout:
+            if raw_lines is not None:
+                raw_lines.append(ln)
+            line_cb(ln)
+        p.stdout.close()
+        err_reader.join()
+        code = p.wait()
+    finally:
+        killer.cancel()
+        if p.poll() is None:
+            p.kill()
+            p.wait()
+    if timed_out.is_set():
+        raise CmdError(f"> Таймаут: {printable}")
+    err = "".join(err_chunks)
+    if raw_label is not None:
+        with _PRINT_LOCK:
+            _log_block(raw_label + "_STDOUT", "".join(raw_lines or []))
+            if err.strip():
+                _log_block(raw_label + "_STDERR", err)
+    return RunResult(code, "", err)
+
 # ====== IAM‑токен ======
 
 def ensure_iam_token() -> str:
@@ -151,9 +242,15 @@ class YdbDb:
     database: str  # /ru-central1/.../...
 
 def _split_ydb_endpoint(full: str) -> Tuple[str, str]:
-    p = urlparse(full.strip())
-    endpoint = f"{p.scheme}://{p.netloc}".rstrip("/")
-    db = (parse_qs(p.query).get("database") or [""])[0]
+    # Формат известен: grpcs://host:port/?database=/ru-central1/... — режем строку сами, без urlparse/parse_qs
+    ep, _, qs = full.strip().partition("?")
+    scheme, sep, rest = ep.partition("://")
+    endpoint = (scheme + sep + rest.split("/", 1)[0]).rstrip("/")
+    db = ""
+    for kv in qs.split("&"):
+        if kv.startswith("database="):
+            db = unquote_plus(kv[len("database="):])
+            break
     return endpoint, db
 
 def _coerce_db_item(item: Dict[str, Any]) -> Optional[YdbDb]:
@@ -175,7 +272,7 @@ def list_ydb_databases() -> List[YdbDb]:
         raise CmdError("> Не удалось получить список баз (yc ydb database list).")
     items: List[YdbDb] = []
     try:
-        data = json.loads(rr.out)
+        data = _jloads(rr.out)
         for it in data:
             db = _coerce_db_item(it)
             if db:
@@ -187,17 +284,79 @@ def list_ydb_databases() -> List[YdbDb]:
     return items
 
 # ====== YDB CLI ======
+BOX_SEP = "│"  # разделитель ячеек в табличном выводе ydb CLI
+_TYPE_RE = re.compile(r"<(table|directory|topic|column_table)>\s+(\S+)")
+# Типы из листинга, которые считаем таблицами (строковые и колоночные)
+_TABLE_TYPES = ("table", "column_table")
+_CELL_RE = {
+    BOX_SEP: re.compile(r"│\s*([^│]*?)\s*(?=│)"),
+    "|": re.compile(r"\|\s*([^|]*?)\s*(?=\|)"),
+}
+
 @dataclass
 class Node:
     name: str
     path: str  # абсолютный
     is_dir: bool
 
+def _header_index(cells: List[str]) -> Dict[str, int]:
+    # Один проход по заголовку вместо нескольких cells.index(); при повторах — первое вхождение, как у index()
+    idx: Dict[str, int] = {}
+    for i, c in enumerate(cells):
+        idx.setdefault(c, i)
+    return idx
+
 class YdbCli:
     def __init__(self, endpoint: str, database: str, token_file: Path):
         self.endpoint = endpoint
         self.database = database
         self.token_file = token_file
+        # Драйвер ydb SDK поднимаем лениво и один раз на сессию; при любой ошибке — ydb CLI
+        self._sdk_lock = threading.Lock()
+        self._sdk_ready = False
+        self._driver: Any = None
+        self._pool: Any = None
+
+    def _sdk(self) -> Any:
+        if not USE_YDB_SDK:
+            return None
+        with self._sdk_lock:
+            if self._sdk_ready:
+                return self._pool
+            self._sdk_ready = True
+            driver = None
+            try:
+                token = self.token_file.read_text(encoding="utf-8").strip()
+                driver = ydb_sdk.Driver(
+                    endpoint=self.endpoint,
+                    database=self.database,
+                    credentials=ydb_sdk.AccessTokenCredentials(token),
+                )
+                driver.wait(timeout=SDK_CONNECT_TIMEOUT, fail_fast=True)
+                self._pool = ydb_sdk.SessionPool(driver, size=DESCRIBE_WORKERS)
+                self._driver = driver
+            except Exception as e:
+                if driver is not None:
+                    try:
+                        driver.stop()
+                    except Exception:
+                        pass
+                with _PRINT_LOCK:
+                    print(f"> ydb SDK недоступен ({e.__class__.__name__}: {e}) — работаем через ydb CLI")
+                self._pool = None
+            return self._pool
+
+    def close(self) -> None:
+        with self._sdk_lock:
+            pool, driver = self._pool, self._driver
+            self._pool = self._driver = None
+        try:
+            if pool is not None:
+                pool.stop()
+            if driver is not None:
+                driver.stop()
+        except Exception:
+            pass
 
     def base(self) -> List[str]:
         return [
@@ -206,48 +365,64 @@ class YdbCli:
         ]
 
     def whoami(self) -> None:
+        if self._sdk() is not None:
+            # Драйвер уже прошёл discovery с нашим токеном — отдельный процесс CLI не нужен
+            print("> ydb SDK: подключение установлено")
+            return
         run(self.base() + ["discovery", "whoami"], timeout=YDB_TIMEOUT, echo_stdout=True, raw_label="RAW_YDB_WHOAMI")
 
-    def scheme_ls_paths(self) -> List[str]:
-        # Самый совместимый способ: один объект в строку (-1) + рекурсивно (‑R)
-        rr = run(self.base() + ["scheme", "ls", "-R1"], timeout=YDB_TIMEOUT, raw_label="RAW_YDB_SCHEME_LS_R1")
-        if rr.code == 0 and rr.out.strip():
-            # Формат похож на ls -R: секции с заголовками "<dir>:" и списком имён ниже
-            entries: List[str] = []
-            cur_dir = ""
-            for ln in rr.out.splitlines():
-                s = ln.strip()
-                if not s:
-                    continue
-                # Заголовок раздела "path:"
-                if s.endswith(":"):
-                    hdr = s[:-1].strip()
-                    if hdr in (".", "./"):
-                        cur_dir = ""
-                    else:
-                        if hdr.startswith("./"):
-                            hdr = hdr[2:]
-                        cur_dir = hdr.strip("/")
-                    continue
-                # Обычная строка-элемент каталога
-                item = s.rstrip("/")
-                path = f"{cur_dir}/{item}" if cur_dir else item
-                # Отсечём системные пути
-                if path == ".sys" or path.startswith(".sys/"):
-                    continue
-                entries.append(path)
-            if entries:
-                return entries
+    def scheme_ls_paths(self) -> List[Tuple[str, str]]:
+        """
+        Список объектов схемы: [(путь, тип)], тип — "table"/"directory"/… или "",
+        если формат вывода его не содержит (-R1). По типу main() отсекает не-таблицы до describe.
+        """
+        # Самый совместимый способ: один объект в строку (-1) + рекурсивно (‑R).
+        # Вывод разбираем построчно по мере поступления — без буфера на весь листинг.
+        # Формат похож на ls -R: секции с заголовками "<dir>:" и списком имён ниже
+        if self._sdk() is not None:
+            try:
+                return self._scheme_ls_sdk()
+            except Exception as e:
+                print(f"> ydb SDK: list_directory не удался ({e.__class__.__name__}) — переходим на ydb CLI")
+        entries: List[Tuple[str, str]] = []
+        cur_dir = ""
+
+        def on_line(ln: str) -> None:
+            nonlocal cur_dir
+            s = ln.strip()
+            if not s:
+                return
+            # Заголовок раздела "path:"
+            if s.endswith(":"):
+                hdr = s[:-1].strip()
+                if hdr in (".", "./"):
+                    cur_dir = ""
+                else:
+                    if hdr.startswith("./"):
+                        hdr = hdr[2:]
+                    cur_dir = hdr.strip("/")
+                return
+            # Обычная строка-элемент каталога
+            item = s.rstrip("/")
+            path = f"{cur_dir}/{item}" if cur_dir else item
+            # Отсечём системные пути
+            if path == ".sys" or path.startswith(".sys/"):
+                return
+            entries.append((path, ""))
+
+        rr = run_stream(self.base() + ["scheme", "ls", "-R1"], timeout=YDB_TIMEOUT, line_cb=on_line, raw_label="RAW_YDB_SCHEME_LS_R1")
+        if rr.code == 0 and entries:
+            return entries
         # Фолбэк: подробный формат (‑lR)
         rr2 = run(self.base() + ["scheme", "ls", "-lR"], timeout=YDB_TIMEOUT, raw_label="RAW_YDB_SCHEME_LS_lR")
         if not rr2.out.strip():
             return []
         # Попробуем выцепить пути из вида "<table> path" / "<directory> path"
-        paths: List[str] = []
+        paths: List[Tuple[str, str]] = []
         for line in rr2.out.splitlines():
-            m = re.search(r"<(?:table|directory|topic|column_table)>\s+(\S+)", line)
+            m = _TYPE_RE.search(line)
             if m:
-                paths.append(m.group(1))
+                paths.append((m.group(2), m.group(1)))
         if paths:
             return paths
         # Разбор табличного вывода (рамки) — берём столбцы Type/Name
@@ -264,15 +439,12 @@ class YdbCli:
             if in_box and s.startswith("└"):
                 in_box = False
                 continue
-            if in_box and "│" in line:
-                cells = [c.strip() for c in line.split("│")]
+            if in_box and BOX_SEP in line:
+                cells = [c.strip() for c in line.split(BOX_SEP)]
                 if ("Type" in cells) and ("Name" in cells):
-                    try:
-                        type_idx = cells.index("Type")
-                        name_idx = cells.index("Name")
-                    except ValueError:
-                        name_idx = None
-                        type_idx = None
+                    idx = _header_index(cells)
+                    type_idx = idx["Type"]
+                    name_idx = idx["Name"]
                     continue
                 if name_idx is None:
                     name = cells[-2] if len(cells) >= 2 else ""
@@ -285,10 +457,125 @@ class YdbCli:
                 if name.startswith(".sys"):
                     continue
                 if str(typ).lower() == "table":
-                    paths.append(name)
+                    paths.append((name, "table"))
         return paths
 
+    def _scheme_ls_sdk(self) -> List[Tuple[str, str]]:
+        # Обход каталогов через scheme_client: пути относительно базы, как у `scheme ls -R1`
+        scheme = self._driver.scheme_client
+        root = self.database.rstrip("/")
+        entries: List[Tuple[str, str]] = []
+        stack = [""]
+        while stack:
+            rel_dir = stack.pop()
+            listing = scheme.list_directory(f"{root}/{rel_dir}" if rel_dir else root)
+            for child in listing.children:
+                rel = f"{rel_dir}/{child.name}" if rel_dir else child.name
+                if rel == ".sys" or rel.startswith(".sys/"):
+                    continue
+                if child.is_directory():
+                    stack.append(rel)
+                elif child.is_table() or getattr(child, "is_column_table", lambda: False)():
+                    # Колоночные таблицы тоже отдаём как "table" (в старых SDK метода нет)
+                    entries.append((rel, "table"))
+        _log_block("RAW_YDB_SDK_SCHEME_LS", "\n".join(p for p, _ in entries))
+        return entries
+
+    # Кэш describe на диске: повторные запуски (пока перебираешь таблицы в UI)
+    # не дёргают ydb CLI заново. Сброс — удалить папку .describe_cache
+    def _cache_file(self, abs_path: str) -> Path:
+        key = hashlib.sha1(f"{self.endpoint}|{self.database}|{abs_path}".encode("utf-8")).hexdigest()
+        return DESCRIBE_CACHE_DIR / f"{key}.json"
+
+    def _cache_get(self, abs_path: str) -> Optional[Dict[str, Any]]:
+        if DESCRIBE_NO_CACHE:
+            return None
+        try:
+            data = _jloads(self._cache_file(abs_path).read_bytes())
+        except (OSError, ValueError):
+            return None
+        if time.time() - float(data.get("ts") or 0) >= DESCRIBE_CACHE_TTL:
+            return None
+        desc = data.get("desc")
+        return desc if isinstance(desc, dict) else None
+
+    def _cache_put(self, abs_path: str, desc: Dict[str, Any]) -> None:
+        if DESCRIBE_NO_CACHE:
+            return
+        try:
+            DESCRIBE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            path = self._cache_file(abs_path)
+            tmp = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+            tmp.write_text(json.dumps({"ts": time.time(), "desc": desc}, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, path)
+        except OSError:
+            pass  # кэш — только ускорение, без него всё работает
+
     def describe(self, abs_path: str) -> Optional[Dict[str, Any]]:
+        cached = self._cache_get(abs_path)
+        if cached is not None:
+            return cached
+        desc = self._describe_uncached(abs_path)
+        if desc is not None:
+            self._cache_put(abs_path, desc)
+        return desc
+
+    def _describe_uncached(self, abs_path: str) -> Optional[Dict[str, Any]]:
+        pool = self._sdk()
+        if pool is not None:
+            try:
+                return self._describe_sdk(pool, abs_path)
+            except ydb_sdk.SchemeError:
+                return None  # не таблица (каталог/топик) или пути нет — как ненулевой код у CLI
+            except Exception:
+                pass  # транспорт/авторизация — пробуем CLI
+        return self._describe_cli(abs_path)
+
+    @staticmethod
+    def _sdk_type(t: Any) -> Tuple[str, bool]:
+        # Приводим тип к виду ydb CLI ("Int64?" для Optional), чтобы сигнатуры и кэш совпадали
+        if isinstance(t, ydb_sdk.OptionalType):
+            return f"{t.item}?", False
+        return str(t), True
+
+    def _describe_sdk(self, pool: Any, abs_path: str) -> Optional[Dict[str, Any]]:
+        td = pool.retry_operation_sync(lambda session: session.describe_table(abs_path))
+        cols: List[Dict[str, Any]] = []
+        for c in td.columns:
+            tp, not_null = self._sdk_type(c.type)
+            cols.append({"name": c.name, "type": tp, "notNull": not_null})
+        pk = list(td.primary_key)
+        columns_raw = "\n".join(f"{c['name']}\t{c['type']}" for c in cols)
+        return {"columns": cols, "primaryKey": pk, "_header": f"<table> {abs_path}", "_raw": "", "_columns_raw": columns_raw}
+
+    def describe_all(self, paths: Sequence[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        describe для пачки путей: {path: desc}, пути без описания в результат не попадают.
+        Одного запроса на все таблицы у YDB нет (системного представления с колонками
+        не существует), поэтому берём кэш, а промахи гоняем параллельно через ydb SDK
+        (одна сессия на поток из пула) или, без него, через ydb CLI.
+        """
+        result: Dict[str, Dict[str, Any]] = {}
+        misses: List[str] = []
+        for p in paths:
+            cached = self._cache_get(p)
+            if cached is not None:
+                result[p] = cached
+            else:
+                misses.append(p)
+        if not misses:
+            return result
+        with ThreadPoolExecutor(max_workers=min(DESCRIBE_WORKERS, len(misses))) as ex:
+            futures = {ex.submit(self._describe_uncached, p): p for p in misses}
+            for fut in as_completed(futures):
+                desc = fut.result()
+                if desc is not None:
+                    p = futures[fut]
+                    self._cache_put(p, desc)
+                    result[p] = desc
+        return result
+
+    def _describe_cli(self, abs_path: str) -> Optional[Dict[str, Any]]:
         rr = run(self.base() + ["scheme", "describe", abs_path], timeout=YDB_TIMEOUT, raw_label=f"RAW_YDB_DESCRIBE:{abs_path}")
         if rr.code != 0 or not rr.out.strip():
             return None
@@ -325,26 +612,24 @@ class YdbCli:
             if not in_columns_box:
                 continue
             # Внутри таблицы "Columns" — парсим строки с разделителем '│' (или '|' на всякий случай)
-            if ("│" not in line) and ("|" not in line):
+            sep = BOX_SEP if BOX_SEP in line else ("|" if "|" in line else None)
+            if sep is None:
                 columns_raw_lines.append(line)
                 continue
-            sep = "│" if "│" in line else "|"
-            cells = [c.strip() for c in line.split(sep)]
+            # Ячейки между разделителями, уже без пробелов (края строки за ячейки не считаются)
+            cells = _CELL_RE[sep].findall(line)
             columns_raw_lines.append(line)
             # Заголовок столбцов внутри бокса: найдём индексы Name/Type/Key
             if ("Name" in cells) and ("Type" in cells):
-                try:
-                    name_idx = cells.index("Name")
-                    type_idx = cells.index("Type")
-                    # Столбец Key может отсутствовать/быть пустым
-                    key_idx = cells.index("Key") if "Key" in cells else None
-                except ValueError:
-                    name_idx = type_idx = key_idx = None
+                idx = _header_index(cells)
+                name_idx = idx["Name"]
+                type_idx = idx["Type"]
+                # Столбец Key может отсутствовать/быть пустым
+                key_idx = idx.get("Key")
                 continue
             # Данные
             if name_idx is None or type_idx is None:
                 continue
-            # Для строк-данных края тоже дают пустые элементы — фильтровать по индексам
             nm = cells[name_idx] if name_idx < len(cells) else ""
             tp = cells[type_idx] if type_idx < len(cells) else ""
             if not nm or nm == "Name":
@@ -358,6 +643,10 @@ class YdbCli:
 
 # ====== сигнатура и цвет ======
 
+def _fast_hash(data: bytes) -> str:
+    # Хеш только для группировки/цвета, криптостойкость не нужна: blake2b быстрее md5
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
 def schema_signature(desc: Dict[str, Any]) -> str:
     cols = desc.get("columns") or []
     pk = set(desc.get("primaryKey") or [])
@@ -371,15 +660,32 @@ def schema_signature(desc: Dict[str, Any]) -> str:
     # Если распарсить не удалось (пусто) — используем сырую секцию Columns
     if not norm:
         raw_box = desc.get("_columns_raw") or desc.get("_raw") or desc.get("_header") or ""
-        h = hashlib.md5(str(raw_box).encode("utf-8")).hexdigest()
-        return json.dumps({"raw": h}, ensure_ascii=False)
-    return json.dumps(norm, ensure_ascii=False)
-
+        h = _fast_hash(str(raw_box).encode("utf-8"))
+        return f"raw\x1f{h}"
+    # Сигнатура нужна только как ключ (равенство/хеш), поэтому вместо JSON — простая склейка
+    # через управляющие ASCII-разделители (\x1e — поля, \x1f — колонки), в именах их не бывает
+    return "\x1f".join(f"{int(a)}\x1e{b}\x1e{c}\x1e{int(d)}" for a, b, c, d in norm)
+
+_SIG_S = 0.6
+_SIG_V = 0.85
+_SIG_V8 = int(_SIG_V * 255)
+_SIG_P8 = int(_SIG_V * (1.0 - _SIG_S) * 255)
+
+def _hue_to_hex(h: float) -> str:
+    # colorsys.hsv_to_rgb, специализированный под фиксированные S/V: v и p — константы,
+    # на каждый цвет считаем только q/t (результат совпадает с colorsys до бита)
+    i = int(h * 6.0)
+    f = (h * 6.0) - i
+    v, p = _SIG_V8, _SIG_P8
+    q = int(_SIG_V * (1.0 - _SIG_S * f) * 255)
+    t = int(_SIG_V * (1.0 - _SIG_S * (1.0 - f)) * 255)
+    rgb = ((v, t, p), (q, v, p), (p, v, t), (p, q, v), (t, p, v), (v, p, q))[i % 6]
+    return "#%02x%02x%02x" % rgb
+
+@functools.lru_cache(maxsize=512)
 def color_for_sig(sig: str) -> str:
-    import hashlib as _h
-    h = int(_h.md5(sig.encode("utf-8")).hexdigest()[:6], 16) / 0xFFFFFF
-    r, g, b = colorsys.hsv_to_rgb(h, 0.6, 0.85)
-    return "#%02x%02x%02x" % (int(r*255), int(g*255), int(b*255))
+    h = int(_fast_hash(sig.encode("utf-8")), 16) / 0xFFFFFFFFFFFFFFFF
+    return _hue_to_hex(h)
 
 # ====== Tkinter UI ======
 class SchemaPicker(tk.Tk):
@@ -424,8 +730,11 @@ class SchemaPicker(tk.Tk):
         self.destroy()
 
 class TableTree(tk.Tk):
-    def __init__(self, ydb: YdbCli, tables: List[str], sig_map: Dict[str, List[str]], item_sig: Dict[str, str]):
+    def __init__(self, ydb: YdbCli, tables: List[str], descs: Optional[Dict[str, Dict[str, Any]]] = None):
         super().__init__()
+        # Путь — ключ и в item_sig, и в iid дерева: повторы из листинга схлопываем,
+        # иначе _total не сойдётся с числом сигнатур и окно не закроется после «Продолжить»
+        tables = list(dict.fromkeys(tables))
         self.title("Схема YDB — выбери таблицу (↑/↓, Enter)")
         self.geometry("980x640")
         self.resizable(True, True)
@@ -436,18 +745,31 @@ class TableTree(tk.Tk):
         self.tree.pack(fill="both", expand=True, padx=12, pady=(0,6))
 
         self.orig_text: Dict[str, str] = {}
-        self.item_sig = item_sig
-        self.sig_map = sig_map
+        # Сигнатуры считаем лениво: окно показываем сразу, describe идёт в фоне
+        # (выбранная таблица — первой), результаты забираем из очереди в потоке Tk
+        self.ydb = ydb
+        self.item_sig: Dict[str, Optional[str]] = {}  # путь -> сигнатура (None — describe не удался)
+        self.sig_map: Dict[str, List[str]] = {}
+        self.sig_tag: Dict[str, str] = {}
+        self.used_tags: Set[str] = set()
         self.selected_table: Optional[str] = None
         self.prev_marked: List[str] = []
+        self._total = len(tables)
+        self._closing = False
 
         root_db = ydb.database.rstrip("/")
         root_iid = f"dir:{root_db}"
         self.tree.insert("", "end", iid=root_iid, text=root_db, tags=("dir_root",))
         self.orig_text[root_iid] = root_db
+        # Наполняем дерево «за кадром»: корень отцеплен, Tk не перерисовывает на каждый insert
+        self.tree.detach(root_iid)
 
         # Построим дерево только из путей таблиц: директории выводим из их родителей
         parent_for_path: Dict[str, str] = {root_db: root_iid}
+        # Запоминаем по ходу вставки, чтобы потом не опрашивать Tk через get_children
+        root_children: List[str] = []
+        first_root_tbl: Optional[str] = None
+        first_tbl: Optional[str] = None
         def ensure_dir(p_abs: str) -> str:
             if p_abs in parent_for_path:
                 return parent_for_path[p_abs]
@@ -458,6 +780,8 @@ class TableTree(tk.Tk):
             self.tree.insert(parent_iid, "end", iid=iid, text=name, tags=("dir",))
             self.orig_text[iid] = name
             parent_for_path[p_abs] = iid
+            if parent_iid == root_iid:
+                root_children.append(iid)
             return iid
 
         for abs_path in sorted(tables):
@@ -467,20 +791,36 @@ class TableTree(tk.Tk):
             name = abs_path.rsplit("/", 1)[-1]
             self.tree.insert(parent_iid, "end", iid=iid, text=name, tags=("tbl",))
             self.orig_text[iid] = name
-
-        # Используем короткие безопасные теги на основе хеша сигнатуры
-        self.sig_tag: Dict[str, str] = {}
-        for sig in self.sig_map.keys():
-            tag = f"sig:{hashlib.md5(sig.encode('utf-8')).hexdigest()[:8]}"
-            self.sig_tag[sig] = tag
-            self.tree.tag_configure(tag, foreground=color_for_sig(sig))
+            if first_tbl is None:
+                first_tbl = iid
+            if parent_iid == root_iid:
+                root_children.append(iid)
+                if first_root_tbl is None:
+                    first_root_tbl = iid
+
+        self.tree.move(root_iid, "", 0)
+
+        # Уже описанные таблицы (например, при определении типа в main) — сразу, остальные в фон
+        todo: List[str] = []
+        for p in sorted(tables):
+            desc = descs.get(p) if descs else None
+            if desc:
+                self._add_sig(p, schema_signature(desc))
+            else:
+                todo.append(p)
+        self._todo: Deque[str] = deque(todo)
+        self._todo_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._results: "queue.Queue[Tuple[str, Optional[str]]]" = queue.Queue()
 
         self.tree.item(root_iid, open=True)
-        for ch in self.tree.get_children(root_iid):
+        for ch in root_children:
             self.tree.item(ch, open=True)
 
         self.tree.bind("<<TreeviewSelect>>", self._on_select)
         self.bind("<Return>", lambda e: self._ok())
+        # Закрытие окна — отмена: с недособранными сигнатурами группа была бы неполной
+        self.protocol("WM_DELETE_WINDOW", self._cancel)
 
         bar = ttk.Frame(self); bar.pack(fill="x", padx=12, pady=6)
         self.info = ttk.Label(bar, text="Выберите таблицу…")
@@ -488,13 +828,84 @@ class TableTree(tk.Tk):
         ttk.Button(bar, text="Продолжить", command=self._ok).pack(side="right", padx=6)
         ttk.Button(bar, text="Отмена", command=self._cancel).pack(side="right")
 
-        # Автовыбор первой таблицы и фокус на дереве, чтобы работали ↑/↓
-        first_tbl = next((i for i in self.tree.get_children(root_iid) if i.startswith("tbl:")), None)
-        if first_tbl:
-            self.tree.selection_set(first_tbl)
-            self.tree.focus(first_tbl)
+        # Автовыбор первой таблицы (предпочтительно в корне базы) и фокус на дереве, чтобы работали ↑/↓
+        auto_tbl = first_root_tbl or first_tbl
+        if auto_tbl:
+            self._prioritize(auto_tbl.split(":", 1)[1])
+            self.tree.see(auto_tbl)
+            self.tree.selection_set(auto_tbl)
+            self.tree.focus(auto_tbl)
         self.tree.focus_set()
 
+        for _ in range(min(DESCRIBE_WORKERS, len(self._todo))):
+            threading.Thread(target=self._sig_worker, daemon=True).start()
+        if self._todo:
+            self.after(50, self._drain_sigs)
+
+    # --- фоновый describe ---
+
+    def _prioritize(self, path: str) -> None:
+        with self._todo_lock:
+            try:
+                self._todo.remove(path)
+            except ValueError:
+                return  # уже описана или описывается
+            self._todo.appendleft(path)
+
+    def _sig_worker(self) -> None:
+        while not self._stop.is_set():
+            with self._todo_lock:
+                if not self._todo:
+                    return
+                path = self._todo.popleft()
+            try:
+                desc = self.ydb.describe(path)
+            except Exception:
+                desc = None
+            self._results.put((path, schema_signature(desc) if desc else None))
+
+    def _add_sig(self, path: str, sig: Optional[str]) -> None:
+        self.item_sig[path] = sig
+        if sig is None:
+            return
+        self.sig_map.setdefault(sig, []).append(path)
+        if sig not in self.sig_tag:
+            # crc32 — только уникальность имени тега в пределах окна; при коллизии добавляем суффикс
+            base_tag = f"sig:{zlib.crc32(sig.encode('utf-8')) & 0xFFFFFFFF:08x}"
+            tag = base_tag
+            i = 1
+            while tag in self.used_tags:
+                tag = f"{base_tag}_{i}"
+                i += 1
+            self.used_tags.add(tag)
+            self.sig_tag[sig] = tag
+            self.tree.tag_configure(tag, foreground=color_for_sig(sig))
+
+    def _drain_sigs(self) -> None:
+        sel = self.selected_table
+        sel_sig = self.item_sig.get(sel) if sel else None
+        refresh = False
+        while True:
+            try:
+                path, sig = self._results.get_nowait()
+            except queue.Empty:
+                break
+            self._add_sig(path, sig)
+            if path == sel or (sig is not None and sig == sel_sig):
+                refresh = True
+        done = len(self.item_sig) >= self._total
+        if done and self._closing:
+            self._closing = False
+            if not self._warn_if_undescribed():
+                self.destroy()
+                return
+        if refresh or done:
+            self._mark_group()
+        if not done:
+            self.after(50, self._drain_sigs)
+
+    # --- UI ---
+
     def _on_select(self, event=None):
         sel = self.tree.selection()
         if not sel:
@@ -504,16 +915,25 @@ class TableTree(tk.Tk):
             return
         path = iid.split(":", 1)[1]
         self.selected_table = path
-        sig = self.item_sig.get(iid)
+        if path not in self.item_sig:
+            self._prioritize(path)
+        self._mark_group()
 
+    def _mark_group(self) -> None:
+        path = self.selected_table
+        if not path:
+            return
+        # На элемент — одно чтение тегов и одна запись text+tags (каждый вызов — round-trip в Tk)
         for it in self.prev_marked:
-            self.tree.item(it, text=self.orig_text[it])
             # Уберём все теги-сигнатуры, оставив прочие
-            cur_tags = list(self.tree.item(it, "tags") or ())
-            cur_tags = [t for t in cur_tags if not t.startswith("sig:")]
-            self.tree.item(it, tags=tuple(cur_tags))
+            cur_tags = self.tree.item(it, "tags") or ()
+            self.tree.item(it, text=self.orig_text[it], tags=tuple(t for t in cur_tags if not t.startswith("sig:")))
         self.prev_marked.clear()
 
+        if path not in self.item_sig:
+            self.info.config(text=f"Выбрано: {path}  —  определяем схему…")
+            return
+        sig = self.item_sig[path]
         if not sig:
             self.info.config(text="Нет сигнатуры для выбранной таблицы")
             return
@@ -522,26 +942,50 @@ class TableTree(tk.Tk):
             iid_tbl = f"tbl:{p}"
             if self.tree.exists(iid_tbl):
                 group_items.append(iid_tbl)
+        new_tag = self.sig_tag.get(sig, "sig")
         for it in group_items:
-            self.tree.item(it, text="✏️ " + self.orig_text[it])
-            cur_tags = set(self.tree.item(it, "tags") or ())
-            cur_tags.add(self.sig_tag.get(sig, "sig"))
-            self.tree.item(it, tags=tuple(cur_tags))
+            cur_tags = self.tree.item(it, "tags") or ()
+            self.tree.item(it, text="✏️ " + self.orig_text[it], tags=tuple(t for t in cur_tags if t != new_tag) + (new_tag,))
         self.prev_marked = group_items
-        self.info.config(text=f"Выбрано: {path}  —  затронет {len(group_items)} табл.")
+        pending = self._total - len(self.item_sig)
+        tail = f" (ещё проверяем {pending})" if pending else ""
+        self.info.config(text=f"Выбрано: {path}  —  затронет {len(group_items)} табл.{tail}")
 
     def _ok(self):
         if not self.selected_table:
             messagebox.showwarning("Выбор таблицы", "Сначала выберите таблицу")
             return
+        if self._warn_if_undescribed():
+            return
+        pending = self._total - len(self.item_sig)
+        if pending:
+            # Группа должна быть полной: закроемся сами, как только фон допишет сигнатуры
+            self._closing = True
+            self.info.config(text=f"Дособираем схемы таблиц (осталось {pending})…")
+            return
         self.destroy()
 
+    def _warn_if_undescribed(self) -> bool:
+        # describe выбранной таблицы не удался — без сигнатуры группа пустая и миграция
+        # вышла бы без целевых таблиц, поэтому такую таблицу выбрать нельзя
+        if self.selected_table in self.item_sig and self.item_sig[self.selected_table] is None:
+            messagebox.showwarning("Выбор таблицы", "Не удалось получить схему выбранной таблицы — выберите другую")
+            return True
+        return False
+
     def _cancel(self):
         self.selected_table = None
         self.destroy()
 
+    def destroy(self):
+        self._stop.set()
+        super().destroy()
+
 # ====== миграция ======
 
+_SAFE_SEG_RE = re.compile(r"[^\w.\- ()]+", re.UNICODE)
+_NAME_SAFE_RE = re.compile(r"[^\w.-]+", re.UNICODE)
+
 def ask_templates_console() -> Tuple[str, str, str]:
     # Имя миграции фиксированное, SQL не спрашиваем — используем шаблоны
     name = "migration"
@@ -552,20 +996,30 @@ def ask_templates_console() -> Tuple[str, str, str]:
 def write_migration_file(name: str, selected_tables: List[str], up_tpl: str, down_tpl: str, dest_dir: Path) -> Path:
     ts = datetime.now().strftime("%Y%m%d%H%M%S")
     # Разрешаем Unicode-имена (включая кириллицу) в файле миграции
-    safe = re.sub(r"[^\w.-]+", "_", name, flags=re.UNICODE).strip("._ ")
+    safe = _NAME_SAFE_RE.sub("_", name).strip("._ ")
     if not safe:
         safe = "migration"
     fname = f"{ts}_" + safe + ".sql"
     path = dest_dir / fname
-    up_lines = [up_tpl.format(table=f"`{t}`") for t in selected_tables]
-    down_lines = [down_tpl.format(table=f"`{t}`") for t in selected_tables]
-    content = (
-        "-- Автосгенерировано create_migration.py (Tk UI, bulk by schema)\n"
-        f"-- Целевые таблицы ({len(selected_tables)}):\n" + "\n".join(f"--  - {t}" for t in selected_tables) + "\n\n" +
-        "-- +goose Up\n-- +goose StatementBegin\n" + "\n".join(up_lines) + "\n-- +goose StatementEnd\n\n" +
-        "-- +goose Down\n-- +goose StatementBegin\n" + "\n".join(down_lines) + "\n-- +goose StatementEnd\n"
-    )
-    path.write_text(content, encoding="utf-8")
+    backticked = [f"`{t}`" for t in selected_tables]
+    # Собираем список строк и склеиваем один раз — без цепочки промежуточных конкатенаций
+    parts = [
+        "-- Автосгенерировано create_migration.py (Tk UI, bulk by schema)",
+        f"-- Целевые таблицы ({len(selected_tables)}):",
+        *(f"--  - {t}" for t in selected_tables),
+        "",
+        "-- +goose Up",
+        "-- +goose StatementBegin",
+        *(up_tpl.format(table=t) for t in backticked),
+        "-- +goose StatementEnd",
+        "",
+        "-- +goose Down",
+        "-- +goose StatementBegin",
+        *(down_tpl.format(table=t) for t in backticked),
+        "-- +goose StatementEnd",
+        "",
+    ]
+    path.write_text("\n".join(parts), encoding="utf-8", newline="")
     return path
 
 # ====== Main ======
@@ -586,27 +1040,32 @@ def main() -> None:
     ydb.whoami()
 
     print("# scheme ls (список путей)")
-    rel_or_abs_paths = ydb.scheme_ls_paths()
-    _log_block("RAW_SCHEME_LS_PATHS_PARSED", "\n".join(rel_or_abs_paths))
+    ls_entries = ydb.scheme_ls_paths()
+    _log_block("RAW_SCHEME_LS_PATHS_PARSED", "\n".join(p for p, _ in ls_entries))
 
-    # Нормализуем в абсолютные пути и оставим только таблицы (через describe)
-    candidates_abs: List[str] = []
-    for p in rel_or_abs_paths:
+    # Нормализуем в абсолютные пути. Объекты, которые листинг уже пометил как не-таблицы
+    # (каталоги, топики…), отбрасываем; известные таблицы берём как есть — их describe ради
+    # сигнатуры сделает окно выбора в фоне. Сейчас описываем только пути без типа (-R1)
+    tables_abs: List[str] = []
+    unknown_abs: List[str] = []
+    for p, typ in ls_entries:
+        if typ and typ not in _TABLE_TYPES:
+            continue
         full = p if p.startswith("/") else (db.database.rstrip("/") + "/" + p)
-        candidates_abs.append(full)
+        (tables_abs if typ else unknown_abs).append(full)
 
-    print(f"# describe кандидатов (всего: {len(candidates_abs)})")
-    tables_abs: List[str] = []
     desc_cache: Dict[str, Dict[str, Any]] = {}
-    for i, abs_path in enumerate(candidates_abs, 1):
-        desc = ydb.describe(abs_path)
-        if not desc:
-            continue
-        desc_cache[abs_path] = desc
-        header = str(desc.get("_header") or "").lower()
-        has_cols = bool(desc.get("columns"))
-        if "<table>" in header or has_cols:
-            tables_abs.append(abs_path)
+    if unknown_abs:
+        print(f"# describe кандидатов без типа (всего: {len(unknown_abs)})")
+        desc_cache = ydb.describe_all(unknown_abs)
+        for abs_path in unknown_abs:
+            desc = desc_cache.get(abs_path)
+            if not desc:
+                continue
+            header = str(desc.get("_header") or "").lower()
+            has_cols = bool(desc.get("columns"))
+            if "<table>" in header or has_cols:
+                tables_abs.append(abs_path)
 
     _log_block("RAW_TABLES_DETECTED", "\n".join(tables_abs))
 
@@ -616,28 +1075,23 @@ def main() -> None:
     if not tables_abs:
         raise CmdError("> Не найдено ни одной таблицы. Приложи сюда блоки RAW_ из вывода выше.")
 
-    print("# сигнатуры таблиц")
-    sig_map: Dict[str, List[str]] = {}
-    item_sig: Dict[str, str] = {}
-    for t in tables_abs:
-        desc = desc_cache.get(t) or ydb.describe(t) or {}
-        sig = schema_signature(desc)
-        sig_map.setdefault(sig, []).append(t)
-        item_sig[f"tbl:{t}"] = sig
-
-    tree_win = TableTree(ydb, tables_abs, sig_map, item_sig)
+    # Сигнатуры считает само окно: лениво и в фоне, начиная с выбранной таблицы
+    tree_win = TableTree(ydb, tables_abs, desc_cache)
     tree_win.mainloop()
+    ydb.close()
     if not tree_win.selected_table:
         print("> Отменено пользователем (этап выбора таблицы)")
         sys.exit(1)
 
     chosen = tree_win.selected_table
-    chosen_sig = item_sig.get(f"tbl:{chosen}")
-    affected = sorted(sig_map.get(chosen_sig, [])) if chosen_sig else []
+    chosen_sig = tree_win.item_sig.get(chosen)
+    affected = sorted(tree_win.sig_map.get(chosen_sig, [])) if chosen_sig else []
+    if not affected:
+        raise CmdError(f"> Не удалось получить схему таблицы {chosen} — миграцию не создаём")
 
     name, up_tpl, down_tpl = ask_templates_console()
     def _safe_seg(s: str) -> str:
-        seg = re.sub(r"[^\w.\- ()]+", "_", s or "", flags=re.UNICODE).strip("._ ")
+        seg = _SAFE_SEG_RE.sub("_", s or "").strip("._ ")
         return seg or "_"
 
     db_last = (db.database.strip("/").split("/") or [""])[-1]
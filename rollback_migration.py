@@ -2,31 +2,43 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
+import functools
+import mmap
+import os
 import re
 import shlex
 import shutil
 import subprocess
 import sys
+import threading
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import IO, Optional, TextIO, Tuple
 
 # === Константы по умолчанию ===
 YDB_SECURE_ENDPOINT: str = "grpcs://ydb.serverless.yandexcloud.net:2135"
 YDB_DATABASE_PATH_DEFAULT: str = "/ru-central1/b1g2bgg0i9r8beucbthc/etnhgtg29jpjakvf0v6d"
 
 PROJECT_ROOT_DIRECTORY: Path = Path(__file__).resolve().parent
+_PROJECT_ROOT_STR: str = os.fspath(PROJECT_ROOT_DIRECTORY)
 IAM_TOKEN_FILE: Path = PROJECT_ROOT_DIRECTORY / "iam.token"
 
 MASK_SECRETS_IN_LOGS = True
+IAM_TOKEN_MAX_BYTES = 8192  # IAM-токен ~1 КБ; больше — явно не тот файл
+SQL_HEADER_SCAN_BYTES = 65536  # сколько байт начала .sql смотрим до полного скана
 
 
 # ---------- helpers ----------
 
 def read_iam_token(file_path: Path) -> str:
-    if not file_path.exists():
-        raise RuntimeError("> Не найден iam.token — сперва запусти create_migration.py")
-    tok = file_path.read_text(encoding="utf-8").strip()
+    try:
+        with open(file_path, "rb") as f:
+            data = f.read(IAM_TOKEN_MAX_BYTES + 1)
+    except FileNotFoundError:
+        raise RuntimeError("> Не найден iam.token — сперва запусти create_migration.py") from None
+    if len(data) > IAM_TOKEN_MAX_BYTES:
+        raise RuntimeError("> Файл iam.token слишком большой для токена — пересоздай токен: python create_migration.py")
+    tok = data.strip().decode("utf-8")
     if not tok:
         raise RuntimeError("> Файл iam.token пуст — пересоздай токен: python create_migration.py")
     return tok
@@ -42,18 +54,26 @@ def build_dsn(endpoint: str, db_path: str, access_token: str) -> str:
     )
 
 
+_TOKEN_RE = re.compile(r"(token=)[^&'\"]+")
+
+
 def mask_secrets_in_text(s: str) -> str:
-    return re.sub(r"(token=)[^&'\"]+", r"\1***", s)
+    return _TOKEN_RE.sub(r"\1***", s)
 
 
-def check_goose_installed() -> None:
+@functools.lru_cache(maxsize=1)
+def _goose_path() -> str:
+    # Ищем goose в PATH один раз за запуск; дальше все вызовы берут путь из кэша
     path = shutil.which("goose")
     if not path:
         raise RuntimeError("> Не найден 'goose' в PATH. Установи: go install github.com/pressly/goose/v3/cmd/goose@latest")
-    try:
-        subprocess.run([path, "-h"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    except Exception:
+    if not os.access(path, os.X_OK):
         raise RuntimeError("> 'goose' найден, но не запускается. Проверь установку/PATH.")
+    return path
+
+
+def check_goose_installed() -> None:
+    _goose_path()
 
 
 @dataclass
@@ -63,18 +83,44 @@ class ProcResult:
     err: str
 
 
+def _pump_stream(stream: IO[str], sink: list[str], echo: Optional[TextIO]) -> None:
+    for line in stream:
+        sink.append(line)
+        if echo is not None:
+            echo.write(line)
+            echo.flush()
+    stream.close()
+
+
+@functools.lru_cache(maxsize=32)
+def _display_arg(a: str) -> str:
+    # Аргумент в виде для лога. DSN с токеном за запуск один и тот же — маскируется
+    # и квотируется один раз, дальше берётся из кэша
+    if MASK_SECRETS_IN_LOGS and "token=" in a:
+        a = mask_secrets_in_text(a)
+    return shlex.quote(a)
+
+
 def run_goose(args: list[str]) -> ProcResult:
-    printable = " ".join(shlex.quote(a) for a in args)
-    if MASK_SECRETS_IN_LOGS:
-        printable = mask_secrets_in_text(printable)
-    print(f"\n$ {printable}")
-    cp = subprocess.run(args, text=True, capture_output=True)
-    out, err = cp.stdout or "", cp.stderr or ""
-    if out.strip():
-        print(out.rstrip())
-    if cp.returncode != 0 and err.strip():
+    printable = " ".join(map(_display_arg, args))
+    print(f"\n$ {printable}", flush=True)
+    if args and args[0] == "goose":
+        args = [_goose_path(), *args[1:]]  # без повторного поиска по PATH
+    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=-1)
+    out_lines: list[str] = []
+    err_lines: list[str] = []
+    # stdout показываем по мере поступления (down-to бывает долгим); stderr копим
+    # в фоне и печатаем только при ошибке. Пайпы читаем потоками: select() на Windows
+    # с пайпами не работает
+    err_reader = threading.Thread(target=_pump_stream, args=(p.stderr, err_lines, None), daemon=True)
+    err_reader.start()
+    _pump_stream(p.stdout, out_lines, sys.stdout)
+    err_reader.join()
+    code = p.wait()
+    out, err = "".join(out_lines), "".join(err_lines)
+    if code != 0 and err.strip():
         print(err.rstrip())
-    return ProcResult(cp.returncode, out, err)
+    return ProcResult(code, out, err)
 
 
 # === типовые ошибки (YDB/goose) ===
@@ -94,18 +140,32 @@ PATTERNS: list[tuple[str, str, bool]] = [
     (r"failed to close DB.*DeadlineExceeded", "> Команда выполнена, но закрытие соединения истекло — игнорируем.", True),
 ]
 
+# Компилируем один раз при импорте, а не на каждый вызов explain_error
+_COMPILED_PATTERNS: list[tuple[re.Pattern[str], str, bool]] = [
+    (re.compile(pat, re.IGNORECASE | re.DOTALL), msg, cont) for pat, msg, cont in PATTERNS
+]
+
 
 def explain_error(stderr: str, stdout: str) -> tuple[str, bool]:
     s = f"{stdout}\n{stderr}"
-    for pat, msg, cont in PATTERNS:
-        if re.search(pat, s, flags=re.IGNORECASE | re.DOTALL):
+    for rx, msg, cont in _COMPILED_PATTERNS:
+        if rx.search(s):
             return msg, cont
     return ("> Неизвестная ошибка goose/YDB — смотри stderr выше.", False)
 
 
-# ---------- выбор файла (Tk) ----------
+# ---------- выбор файла (аргумент/переменная окружения или Tk) ----------
+
+def migration_file_from_cli() -> Optional[Path]:
+    # Файл можно передать первым аргументом или через GOOSE_ROLLBACK_FILE — тогда Tk не поднимаем
+    for a in sys.argv[1:]:
+        if not a.startswith("--"):
+            return Path(a)
+    env_file = os.environ.get("GOOSE_ROLLBACK_FILE")
+    return Path(env_file) if env_file else None
 
-def pick_migration_file(start_dir: Path) -> Path:
+
+def pick_migration_file(start_dir: str) -> Path:
     try:
         import tkinter as tk
         from tkinter import filedialog
@@ -115,7 +175,7 @@ def pick_migration_file(start_dir: Path) -> Path:
     root = tk.Tk()
     root.withdraw()
     path_str = filedialog.askopenfilename(
-        initialdir=str(start_dir),
+        initialdir=start_dir,
         title="Выбери файл миграции для ОТКАТА (.sql)",
         filetypes=[("SQL files", "*.sql"), ("All files", "*.*")],
     )
@@ -127,33 +187,51 @@ def pick_migration_file(start_dir: Path) -> Path:
 
 # ---------- утилиты goose ----------
 
-def goose_status(dsn: str, migrations_dir: Path) -> None:
-    args = ["goose", "-dir", str(migrations_dir), "ydb", dsn, "status"]
-    pr = run_goose(args)
+def goose_base(dsn: str, migrations_dir: Path) -> tuple[str, ...]:
+    # Общий префикс всех вызовов goose: собираем один раз в main
+    return ("goose", "-dir", os.fspath(migrations_dir), "ydb", dsn)
+
+
+def _goose_cmd(base: tuple[str, ...], *tail: str) -> list[str]:
+    return [*base, *tail]
+
+
+def goose_status(base: tuple[str, ...]) -> ProcResult:
+    pr = run_goose(_goose_cmd(base, "status"))
     if pr.code == 0:
-        return
+        return pr
     msg, cont = explain_error(pr.err, pr.out)
     print(msg)
     if not cont:
         raise SystemExit(1)
+    return pr
 
 
-def goose_version(dsn: str, migrations_dir: Path) -> Optional[int]:
-    args = ["goose", "-dir", str(migrations_dir), "ydb", dsn, "version"]
-    pr = run_goose(args)
-    txt = (pr.out or "") + "\n" + (pr.err or "")
-    m = re.search(r"version\s+(\d+)", txt, re.IGNORECASE)
-    if (pr.code == 0 or "failed to close DB" in txt) and m:
-        try:
-            return int(m.group(1))
-        except ValueError:
-            return None
-    return None
-
-
-def goose_down_to(dsn: str, migrations_dir: Path, target_version: int) -> None:
-    args = ["goose", "-dir", str(migrations_dir), "ydb", dsn, "down-to", str(target_version)]
-    pr = run_goose(args)
+def applied_version_from_status(pr: ProcResult) -> Optional[int]:
+    """
+    Версия по выводу `goose status` вместо отдельного `goose version` (лишний процесс и
+    подключение к YDB). Строки таблицы: "<время применения|Pending> -- <файл>".
+    Возвращает максимальную применённую версию среди миграций папки, 0 — если применённых
+    нет, None — если таблицу статуса разобрать не удалось.
+    """
+    best: Optional[int] = None
+    for txt in (pr.out, pr.err):
+        for line in (txt or "").splitlines():
+            left, sep, right = line.rpartition(" -- ")
+            if not sep:
+                continue
+            ver = extract_version_from_filename(Path(right.strip()).name)
+            if ver is None:
+                continue
+            if left.rstrip().endswith("Pending"):
+                best = best or 0
+            elif best is None or ver > best:
+                best = ver
+    return best
+
+
+def goose_down_to(base: tuple[str, ...], target_version: int) -> None:
+    pr = run_goose(_goose_cmd(base, "down-to", str(target_version)))
     if pr.code == 0:
         return
     msg, cont = explain_error(pr.err, pr.out)
@@ -164,70 +242,106 @@ def goose_down_to(dsn: str, migrations_dir: Path, target_version: int) -> None:
 
 # ---------- разбор файла ----------
 
-def detect_targets_hint(sql_text: str) -> list[str]:
-    targets: list[str] = []
-    for line in sql_text.splitlines():
-        line = line.strip()
-        if line.startswith("--  - "):  # из create_migration.py
-            targets.append(line[6:].strip())
-        else:
-            m = re.search(r"`(/ru-central1/[^`]+)`", line)  # ALTER TABLE `/ru-central1/...`
-            if m:
-                targets.append(m.group(1))
-    # уникализируем с сохранением порядка
-    seen = set()
-    uniq = []
-    for t in targets:
-        if t not in seen:
-            seen.add(t)
-            uniq.append(t)
-    return uniq
+# Версия из имени файла одним match: первая «длинная» (6+) серия цифр, а если такой нет —
+# первая любая. Ленивый .*? перебирает позиции слева направо, поэтому первая альтернатива
+# находит то же, что re.search(r"\d{6,}"); вторая срабатывает, только если первая не нашла
+_RE_VER = re.compile(r".*?(\d{6,})|\D*(\d+)", re.DOTALL)
+# Регулярки разбора SQL — байтовые: файл миграции сканируем прямо через mmap,
+# декодируем только найденные фрагменты.
+# Строка-комментарий "--  - <путь>" из create_migration.py: ищем её регуляркой по всему
+# тексту (MULTILINE), без разбиения на строки. Захват — до конца строки без хвостовых пробелов/\r
+_COMMENT_TARGET_PREFIX = rb"^[ \t]*--  - [ \t]*"
+_COMMENT_TARGET_TAIL = rb"[ \t\r]*$"
+# Одна регулярка на весь текст: строка-комментарий (занимает строку целиком) или путь в бэктиках внутри DDL
+_TARGETS_RE = re.compile(
+    _COMMENT_TARGET_PREFIX + rb"(\S[^\n]*?)" + _COMMENT_TARGET_TAIL
+    + rb"|`(/ru-central1/[^`\n]+)`",
+    re.MULTILINE,
+)
+# Источники database path за один проход: 1) комментарий "--  - <путь>",
+# 2) путь в бэктиках (ALTER TABLE `/ru-central1/...`), 3) «сырой» путь
+_DBP_SOURCES_RE = re.compile(
+    _COMMENT_TARGET_PREFIX + rb"(/ru-central1/[^\n]*?)" + _COMMENT_TARGET_TAIL
+    + rb"|`(/ru-central1/[^`\n]+)`"  # как в _TARGETS_RE: не через перевод строки
+    rb"|(/ru-central1/[A-Za-z0-9_\-]+/[A-Za-z0-9_\-]+)",  # id облака/базы в YDB — только ASCII
+    re.MULTILINE,
+)
+
+
+def _dec(b: bytes) -> str:
+    return b.decode("utf-8", "ignore")
+
+
+def detect_targets_hint(sql: bytes | mmap.mmap) -> list[str]:
+    # dict.fromkeys — уникализация с сохранением порядка
+    return list(dict.fromkeys(_dec(m.group(1) or m.group(2)) for m in _TARGETS_RE.finditer(sql)))
+
+
+_RU_CENTRAL_PREFIX = "/ru-central1/"
 
 
 def extract_db_path_from_abs_table(abs_table_path: str) -> Optional[str]:
     """
     /ru-central1/<cloud>/<db>/<...> -> /ru-central1/<cloud>/<db>
     """
-    if not abs_table_path.startswith("/ru-central1/"):
+    if not abs_table_path.startswith(_RU_CENTRAL_PREFIX):
         return None
-    parts = abs_table_path.strip("/").split("/")
-    if len(parts) < 3:
+    # Нужны только <cloud> и <db>: maxsplit не режет хвост пути на лишние куски.
+    # rstrip("/") — как strip("/") раньше: «/ru-central1/a/» без db не считается путём базы
+    parts = abs_table_path[len(_RU_CENTRAL_PREFIX):].rstrip("/").split("/", 2)
+    if len(parts) < 2:
         return None
-    return "/" + "/".join(parts[:3])
-
-
-def detect_db_path_from_sql(sql_text: str) -> Optional[str]:
-    # 1) из комментариев
-    for line in sql_text.splitlines():
-        line = line.strip()
-        if line.startswith("--  - "):
-            candidate = line[6:].strip()
-            dbp = extract_db_path_from_abs_table(candidate)
+    return f"{_RU_CENTRAL_PREFIX}{parts[0]}/{parts[1]}"
+
+
+def detect_db_path_from_sql(sql: bytes | mmap.mmap) -> Optional[str]:
+    # Один проход по тексту. Приоритет источников прежний: комментарий — сразу ответ,
+    # иначе первый путь из бэктиков, иначе первый «сырой» путь
+    from_ticks: Optional[str] = None
+    from_raw: Optional[str] = None
+    for m in _DBP_SOURCES_RE.finditer(sql):
+        comment, ticked, raw = m.groups()
+        if comment is not None:
+            dbp = extract_db_path_from_abs_table(_dec(comment))
             if dbp:
                 return dbp
-    # 2) из ALTER с бэктиками
-    for m in re.finditer(r"`(/ru-central1/[^`]+)`", sql_text):
-        dbp = extract_db_path_from_abs_table(m.group(1))
-        if dbp:
-            return dbp
-    # 3) из «сырых» путей
-    m = re.search(r"(/ru-central1/[\w\-]+/[\w\-]+)", sql_text)
-    if m:
-        return m.group(1)
-    return None
+        elif ticked is not None:
+            if from_ticks is None:
+                from_ticks = extract_db_path_from_abs_table(_dec(ticked))
+        elif from_raw is None:
+            from_raw = _dec(raw)
+    return from_ticks or from_raw
+
+
+def scan_header(path: Path, max_bytes: int = SQL_HEADER_SCAN_BYTES) -> tuple[list[str], Optional[str]]:
+    """
+    Подсказки по таблицам и database path из начала файла: create_migration.py пишет
+    список «--  - <путь>» в шапку, так что большие файлы целиком читать не нужно.
+    Если в первых max_bytes чего-то не нашлось — полный скан через mmap.
+    """
+    with open(path, "rb") as f:
+        head = f.read(max_bytes + 1)
+        if len(head) <= max_bytes:  # файл целиком поместился — это и есть полный скан
+            return detect_targets_hint(head), detect_db_path_from_sql(head)
+        # Режем по последней целой строке, чтобы не получить обрубленный путь
+        cut = head.rfind(b"\n", 0, max_bytes)
+        head = head[:cut + 1] if cut >= 0 else head[:max_bytes]
+        targets = detect_targets_hint(head)
+        db_path = detect_db_path_from_sql(head)
+        if targets and db_path:
+            return targets, db_path
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return detect_targets_hint(mm), detect_db_path_from_sql(mm)
 
 
 def extract_version_from_filename(file_name: str) -> Optional[int]:
     """
     НЕ валидируем строго. Берём первую «длинную» последовательность цифр в имени файла как версию.
     """
-    m = re.search(r"(\d{6,})", file_name) or re.search(r"(\d+)", file_name)
+    m = _RE_VER.match(file_name)
     if not m:
         return None
-    try:
-        return int(m.group(1))
-    except ValueError:
-        return None
+    return int(m.group(1) or m.group(2))
 
 
 # ---------- main ----------
@@ -240,17 +354,18 @@ def main() -> None:
     token = read_iam_token(IAM_TOKEN_FILE)
 
     print("🗂 Выбираем .sql для ОТКАТА...")
-    chosen = pick_migration_file(PROJECT_ROOT_DIRECTORY)
+    chosen = migration_file_from_cli() or pick_migration_file(_PROJECT_ROOT_STR)
     if not chosen.exists():
         raise RuntimeError(f"> Файл не найден: {chosen}")
 
-    # читаем SQL для подсказок
+    # читаем SQL для подсказок: обычно хватает шапки файла
+    targets: list[str] = []
+    db_path_detected: Optional[str] = None
     try:
-        raw_sql = chosen.read_text(encoding="utf-8", errors="ignore")
-    except Exception:
-        raw_sql = ""
+        targets, db_path_detected = scan_header(chosen)
+    except OSError:
+        pass
 
-    targets = detect_targets_hint(raw_sql)
     if targets:
         print(f"📦 Файл содержит абсолютные пути к {len(targets)} таблицам:")
         for t in targets[:12]:
@@ -260,8 +375,7 @@ def main() -> None:
     else:
         print("📦 Подсказки по таблицам не найдены в комментариях/DDL.")
 
-    # Определим database path из файла, если возможно
-    db_path_detected = detect_db_path_from_sql(raw_sql)
+    # database path из файла, если удалось определить
     db_path_final = db_path_detected or YDB_DATABASE_PATH_DEFAULT
     if db_path_detected and db_path_detected != YDB_DATABASE_PATH_DEFAULT:
         print(f"🏷  Обнаружен database path в файле миграции: {db_path_detected}")
@@ -272,15 +386,11 @@ def main() -> None:
     print("🔗 Готовим DSN для YDB...")
     dsn = build_dsn(YDB_SECURE_ENDPOINT, db_path_final, token)
 
-    mig_dir = chosen.parent.resolve()
-
-    print("\n🔎 Статус до отката:")
-    goose_status(dsn, mig_dir)
-
-    cur_ver = goose_version(dsn, mig_dir)
-    if cur_ver is not None:
-        print(f"> Текущая версия БД: {cur_ver}")
+    # Без resolve(): goose принимает и относительный -dir (cwd тот же), а realpath — лишние syscalls
+    mig_dir = chosen.parent
+    base = goose_base(dsn, mig_dir)
 
+    # Версию из имени проверяем до первого вызова goose: без неё откатывать нечем
     version = extract_version_from_filename(chosen.name)
     if version is None:
         print(
@@ -290,15 +400,22 @@ def main() -> None:
         )
         sys.exit(2)
 
+    print("\n🔎 Статус до отката:")
+    # Текущую версию берём из того же вывода status — отдельный `goose version` не запускаем
+    cur_ver = applied_version_from_status(goose_status(base))
+    if cur_ver is not None:
+        print(f"> Последняя применённая версия (по status): {cur_ver}")
+
     if cur_ver is not None and cur_ver < version:
+        # Состояние не менялось — повторный status (ещё один процесс goose и подключение) не нужен
         print(f"\n> Выбранная миграция {version} ещё не применена (текущая версия {cur_ver}). Откатывать нечего.")
     else:
         target = version - 1
         print(f"\n⏪ Выполняем откат: down-to {target} (снимет выбранную миграцию и все более новые).")
-        goose_down_to(dsn, mig_dir, target)
+        goose_down_to(base, target)
 
-    print("\n🔎 Статус после отката:")
-    goose_status(dsn, mig_dir)
+        print("\n🔎 Статус после отката:")
+        goose_status(base)
 
     print("\n✅ Откат завершён.")
 